@@ -1,6 +1,10 @@
+from itertools import chain
+
 from pyformlang.regular_expression import Regex
 from pyformlang.finite_automaton import DeterministicFiniteAutomaton
 from pyformlang.finite_automaton import NondeterministicFiniteAutomaton
+from pyformlang.finite_automaton import NondeterministicTransitionFunction
+from pyformlang.finite_automaton import State, Symbol
 import networkx as nx
 
 
@@ -9,22 +13,31 @@ def regex_to_dfa(exp: str) -> DeterministicFiniteAutomaton:
 
 
 def graph_to_nfa(
-    graph: nx.MultiDiGraph, starts=[], finals=[]
+    graph: nx.MultiDiGraph, starts=None, finals=None
 ) -> NondeterministicFiniteAutomaton:
-    nfa = NondeterministicFiniteAutomaton(graph)
-
-    if not starts:
-        for node in graph.nodes():
-            nfa.add_start_state(node)
-    if not finals:
-        for node in graph.nodes():
-            nfa.add_final_state(node)
-
-    for node in starts:
-        nfa.add_start_state(node)
-    for node in finals:
-        nfa.add_final_state(node)
+    states = {node: State(node) for node in graph.nodes}
+    symbols = {}
+
+    # States and symbols are created once, the transition function is filled
+    # directly instead of through the automaton's per-edge add_transition
+    transition_function = NondeterministicTransitionFunction()
     for a, b, data in graph.edges(data="label"):
-        nfa.add_transition(a, data, b)
+        symbol = symbols.get(data)
+        if symbol is None:
+            symbol = symbols[data] = Symbol(data)
+        transition_function.add_transition(states[a], symbol, states[b])
+
+    def or_all(nodes):
+        # Empty means every node; peek at the first node so that any iterable
+        # is passed on as is, the automaton makes its own set from it
+        nodes = iter(() if nodes is None else nodes)
+        first = next(nodes, None)
+        return states.values() if first is None else chain([first], nodes)
 
-    return nfa
+    return NondeterministicFiniteAutomaton(
+        states=states.values(),
+        input_symbols=symbols.values(),
+        transition_function=transition_function,
+        start_state=or_all(starts),
+        final_states=or_all(finals),
+    )
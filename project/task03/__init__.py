@@ -1,7 +1,23 @@
 from project.task03.main import (
     FiniteAutomaton,
+    PairSet,
+    graph_automaton,
     intersect_automata,
+    graph_nodes,
     paths_ends,
+    paths_ends_chunks,
+    prepare_graph,
+    regex_to_fa,
 )
 
-__all__ = [FiniteAutomaton, intersect_automata, paths_ends]
+__all__ = [
+    FiniteAutomaton,
+    PairSet,
+    graph_automaton,
+    intersect_automata,
+    graph_nodes,
+    paths_ends,
+    paths_ends_chunks,
+    prepare_graph,
+    regex_to_fa,
+]
@@ -1,18 +1,140 @@
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, Set
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+from typing import TextIO
+import json
+
 import numpy as np
 from pyformlang.finite_automaton import (
     DeterministicFiniteAutomaton,
     NondeterministicFiniteAutomaton,
+    NondeterministicTransitionFunction,
+    State,
+    Symbol,
 )
-from scipy.sparse import csr_matrix, kron
+from scipy.sparse import coo_matrix, csr_matrix, eye, kron
 
-from project.task02 import graph_to_nfa, regex_to_dfa
+from project.task02 import regex_to_dfa
 from networkx import MultiDiGraph
 from networkx.classes.reportviews import NodeView
 
 
+class LRUCache:
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        self.misses += 1
+        value = build()
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def info(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.items),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        self.items.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+class SortedStateMap(Mapping):
+
+    def __init__(self, states: np.ndarray, order: np.ndarray = None):
+        # states[order] is sorted; without an order the states already are
+        self.states = states
+        self.order = order
+
+    def __getitem__(self, state) -> int:
+        try:
+            i = int(np.searchsorted(self.states, state, sorter=self.order))
+        except (TypeError, ValueError):
+            raise KeyError(state)
+        if i < len(self.states):
+            i = self.__position(i)
+            if self.states[i] == state:
+                return int(i)
+        raise KeyError(state)
+
+    def indices(self, states, skip_missing: bool = False) -> np.ndarray:
+        states = list(states)
+        try:
+            states = np.fromiter(states, dtype=self.states.dtype, count=len(states))
+        except (TypeError, ValueError, OverflowError):
+            if not skip_missing:
+                raise KeyError(states)
+            return np.fromiter((self[s] for s in states if s in self), dtype=np.int64)
+        indices = np.searchsorted(self.states, states, sorter=self.order)
+        found = indices < len(self.states)
+        indices[found] = self.__position(indices[found])
+        found[found] = self.states[indices[found]] == states[found]
+        if skip_missing:
+            return indices[found]
+        if not found.all():
+            raise KeyError(states[~found][0])
+        return indices
+
+    def __position(self, i):
+        return i if self.order is None else self.order[i]
+
+    def __iter__(self):
+        return iter(self.states.tolist())
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+
+class IdentityStateMap(Mapping):
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def __getitem__(self, state) -> int:
+        if isinstance(state, (int, np.integer)) and 0 <= state < self.n:
+            return int(state)
+        raise KeyError(state)
+
+    def indices(self, states, skip_missing: bool = False) -> np.ndarray:
+        if skip_missing:
+            return np.fromiter((s for s in states if s in self), dtype=np.int64)
+        indices = np.fromiter(states, dtype=np.int64)
+        if np.any((indices < 0) | (indices >= self.n)):
+            raise KeyError(indices[(indices < 0) | (indices >= self.n)][0])
+        return indices
+
+    def __iter__(self):
+        return iter(range(self.n))
+
+    def __len__(self) -> int:
+        return self.n
+
+
 class FiniteAutomaton:
 
-    def __init__(self, automaton=None, start=None, final=None, state_map=None):
+    def __init__(
+        self, automaton=None, start=None, final=None, state_map=None, int_map=None
+    ):
 
         if isinstance(
             automaton, (DeterministicFiniteAutomaton, NondeterministicFiniteAutomaton)
@@ -20,125 +142,590 @@ class FiniteAutomaton:
             self.matrix, self.start, self.final, self.state_map = (
                 FiniteAutomaton.__from_nfa(automaton)
             )
-            self.int_map = list(automaton.states)
+            self.int_map = [state.value for state in automaton.states]
         else:
             self.matrix = automaton
-            self.start = set() if start is None else start
-            self.final = set() if final is None else final
+            self.start = index_array(start)
+            self.final = index_array(final)
             self.state_map = dict() if state_map is None else state_map
+            self.int_map = list(self.state_map) if int_map is None else int_map
+
+        self.start_mask = np.zeros(self.size(), dtype=bool)
+        self.start_mask[self.start] = True
+        self.final_mask = np.zeros(self.size(), dtype=bool)
+        self.final_mask[self.final] = True
+
+    @classmethod
+    def from_graph(
+        cls, graph: MultiDiGraph, start_nodes=None, final_nodes=None
+    ) -> "FiniteAutomaton":
+        nodes = list(graph.nodes)
+        state_map = {v: i for i, v in enumerate(nodes)}
+
+        edges = dict()
+        for u, v, label in graph.edges(data="label"):
+            rows, cols = edges.setdefault(label, ([], []))
+            rows.append(state_map[u])
+            cols.append(state_map[v])
+
+        n = len(nodes)
+        matrix = {
+            label: bool_matrix(rows, cols, n) for label, (rows, cols) in edges.items()
+        }
+
+        return cls(matrix, None, None, state_map, nodes).with_states(
+            start_nodes, final_nodes
+        )
+
+    @classmethod
+    def from_csv(
+        cls, path: Path | str, start_nodes=None, final_nodes=None
+    ) -> "FiniteAutomaton":
+        edges = dict()
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                u, v, label = line.split()
+                sources, targets = edges.setdefault(label, (array("q"), array("q")))
+                sources.append(int(u))
+                targets.append(int(v))
+
+        ends = [
+            np.frombuffer(buffer, dtype=np.int64)
+            for pair in edges.values()
+            for buffer in pair
+        ]
+        nodes, inverse = np.unique(
+            np.concatenate(ends) if ends else np.empty(0, dtype=np.int64),
+            return_inverse=True,
+        )
+        offsets = np.cumsum([0] + [len(buffer) for buffer in ends])
+
+        n = len(nodes)
+        matrix = dict()
+        for k, label in enumerate(edges):
+            rows = inverse[offsets[2 * k] : offsets[2 * k + 1]]
+            cols = inverse[offsets[2 * k + 1] : offsets[2 * k + 2]]
+            matrix[label] = bool_matrix(rows, cols, n)
+
+        return cls(matrix, None, None, SortedStateMap(nodes), nodes).with_states(
+            start_nodes, final_nodes
+        )
+
+    def with_states(self, start_nodes=None, final_nodes=None) -> "FiniteAutomaton":
+        return FiniteAutomaton(
+            dict(self.matrix),
+            self.state_indices(start_nodes),
+            self.state_indices(final_nodes),
+            self.state_map,
+            self.int_map,
+        )
+
+    def state_indices(self, states=None) -> np.ndarray:
+        # Like graph_to_nfa, no states at all means every state; states that
+        # are not in the automaton can not be on any path and are skipped
+        if states is None or len(states) == 0:
+            return np.arange(self.size())
+        return lookup_states(self.state_map, states, skip_missing=True)
+
+    def node_mask(self, nodes=None) -> np.ndarray:
+        # Unlike state_indices, an empty set selects nothing
+        if nodes is None:
+            return np.ones(self.size(), dtype=bool)
+        mask = np.zeros(self.size(), dtype=bool)
+        mask[lookup_states(self.state_map, nodes, skip_missing=True)] = True
+        return mask
+
+    def node_ids(self, indices: np.ndarray) -> np.ndarray:
+        return node_ids(self.int_map, indices)
+
+    def save(self, path: Path | str):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        labels = save_matrices(path, self.matrix)
+
+        states = node_table(self.int_map)
+        np.save(path / "states.npy", states, allow_pickle=states.dtype == object)
+        if states.dtype.kind in "iu":
+            np.save(path / "order.npy", np.argsort(states, kind="stable"))
+        np.save(path / "start.npy", self.start)
+        np.save(path / "final.npy", self.final)
+
+        meta = {
+            "size": self.size(),
+            "object_states": bool(states.dtype == object),
+            "labels": labels,
+        }
+        with open(path / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path: Path | str, mmap_mode: str = "r") -> "FiniteAutomaton":
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+
+        matrix = load_matrices(path, meta["labels"], meta["size"], mmap_mode)
+
+        if meta.get("object_states"):
+            states = np.load(path / "states.npy", allow_pickle=True)
+        else:
+            states = np.load(path / "states.npy", mmap_mode=mmap_mode)
+        if states.dtype.kind in "iu":
+            order = np.load(path / "order.npy", mmap_mode=mmap_mode)
+            state_map = SortedStateMap(states, order)
+        else:
+            states = states.tolist()
+            state_map = {v: i for i, v in enumerate(states)}
+
+        start = np.load(path / "start.npy")
+        final = np.load(path / "final.npy")
+
+        return cls(matrix, start, final, state_map, states)
 
     def accepts(self, word) -> bool:
-        nfa = FiniteAutomaton.__to_nfa(self)
-        return nfa.accepts("".join(list(word)))
+        states = self.start
+        for symbol in word:
+            if symbol not in self.matrix:
+                return False
+            states = self.__step(states, [symbol])
+        return bool(self.final_mask[states].any())
 
     def is_empty(self) -> bool:
-        nfa = FiniteAutomaton.__to_nfa(self)
-        return nfa.is_empty()
+        visited = self.start_mask.copy()
+        front = self.start
+        while len(front):
+            if self.final_mask[front].any():
+                return False
+            reached = self.__step(front, self.matrix.keys())
+            front = reached[~visited[reached]]
+            visited[front] = True
+        return True
+
+    def __step(self, states: np.ndarray, labels) -> np.ndarray:
+        reached = [np.empty(0, dtype=np.int64)]
+        reached += [self.matrix[label][states].indices for label in labels]
+        return np.unique(np.concatenate(reached))
+
+    def freeze(self) -> "FiniteAutomaton":
+        for matrix in self.matrix.values():
+            read_only(matrix.data, matrix.indices, matrix.indptr)
+        read_only(self.start, self.final, self.start_mask, self.final_mask)
+        self.matrix = MappingProxyType(self.matrix)
+        if isinstance(self.state_map, dict):
+            self.state_map = MappingProxyType(self.state_map)
+        if isinstance(self.int_map, np.ndarray):
+            read_only(self.int_map)
+        else:
+            self.int_map = tuple(self.int_map)
+        return self
 
     def size(self):
         return len(self.state_map)
 
-    def start_indices(self):
-        return {self.state_map[i] for i in self.start}
+    def start_indices(self) -> np.ndarray:
+        return self.start
 
-    def final_indices(self):
-        return {self.state_map[i] for i in self.final}
+    def final_indices(self) -> np.ndarray:
+        return self.final
 
     @staticmethod
     def __from_nfa(automaton: NondeterministicFiniteAutomaton) -> tuple:
         n = len(automaton.states)
-        states = automaton.to_dict()
         state_map = {v: i for i, v in enumerate(automaton.states)}
 
-        # В старой домашке тесты без этого проходят
-        def to_set(a):
-            return a if isinstance(a, set) else {a}
+        edges = {label: ([], []) for label in automaton.symbols}
+        for u, label, v in automaton:
+            if label in edges:
+                rows, cols = edges[label]
+                rows.append(state_map[u])
+                cols.append(state_map[v])
+
+        matrix = {
+            label: bool_matrix(rows, cols, n) for label, (rows, cols) in edges.items()
+        }
+
+        start = index_array(state_map[s] for s in automaton.start_states)
+        final = index_array(state_map[s] for s in automaton.final_states)
+
+        return matrix, start, final, state_map
+
+    def edges(self):
+        int_map = self.int_map
+        for label, matrix in self.matrix.items():
+            label = getattr(label, "value", label)
+            rows, cols = matrix.nonzero()
+            for u, v in zip(rows.tolist(), cols.tolist()):
+                yield int_map[u], label, int_map[v]
+
+    def to_nfa(self) -> NondeterministicFiniteAutomaton:
+        # As in graph_to_nfa, states and symbols are created once and the
+        # transition function is filled before the automaton is built
+        states = [State(v) for v in self.int_map]
+        symbols = []
+        transition_function = NondeterministicTransitionFunction()
+        for label, matrix in self.matrix.items():
+            symbol = Symbol(getattr(label, "value", label))
+            symbols.append(symbol)
+            rows, cols = matrix.nonzero()
+            for u, v in zip(rows.tolist(), cols.tolist()):
+                transition_function.add_transition(states[u], symbol, states[v])
+
+        return NondeterministicFiniteAutomaton(
+            states=states,
+            input_symbols=symbols,
+            transition_function=transition_function,
+            start_state=[states[s] for s in self.start.tolist()],
+            final_states=[states[s] for s in self.final.tolist()],
+        )
+
+    def write_csv(self, output: Path | str | TextIO):
+        # from_csv reads whitespace separated integer ids, so anything else
+        # could not be read back
+        if len(self.int_map) and node_table(self.int_map).dtype.kind not in "iu":
+            raise ValueError("Only integer node ids can be written as csv")
+        for label in self.matrix:
+            label = str(getattr(label, "value", label))
+            if label.split() != [label]:
+                raise ValueError(f"Label can not be written as csv: {label!r}")
+
+        with text_output(output) as f:
+            f.writelines(f"{u} {v} {label}\n" for u, label, v in self.edges())
+
+    def write_dot(self, output: Path | str | TextIO):
+        def quote(value):
+            return json.dumps(str(value))
+
+        with text_output(output) as f:
+            f.write("digraph {\n")
+            f.writelines(
+                f"{quote(self.int_map[s])} [is_start=True];\n"
+                for s in self.start.tolist()
+            )
+            f.writelines(
+                f"{quote(self.int_map[s])} [is_final=True];\n"
+                for s in self.final.tolist()
+            )
+            f.writelines(
+                f"{quote(u)} -> {quote(v)} [label={quote(label)}];\n"
+                for u, label, v in self.edges()
+            )
+            f.write("}\n")
+
+
+class PairSet(Set):
+
+    def __init__(self, matrix: csr_matrix, state_map, int_map):
+        self.matrix = matrix.tocsr()
+        self.matrix.sort_indices()
+        self.state_map = state_map
+        self.int_map = int_map
+
+    @classmethod
+    def from_indices(cls, rows, cols, fa: FiniteAutomaton) -> "PairSet":
+        return cls(bool_matrix(rows, cols, fa.size()), fa.state_map, fa.int_map)
+
+    @classmethod
+    def from_pairs(cls, pairs, fa: FiniteAutomaton) -> "PairSet":
+        pairs = list(pairs)
+        rows = lookup_states(fa.state_map, [u for u, _ in pairs])
+        cols = lookup_states(fa.state_map, [v for _, v in pairs])
+        return cls.from_indices(rows, cols, fa)
+
+    @classmethod
+    def _from_iterable(cls, pairs):
+        return set(pairs)
+
+    def __contains__(self, pair) -> bool:
+        try:
+            u, v = pair
+            i, j = self.state_map[u], self.state_map[v]
+        except (KeyError, TypeError, ValueError):
+            return False
+        indptr, indices = self.matrix.indptr, self.matrix.indices
+        row = indices[indptr[i] : indptr[i + 1]]
+        k = np.searchsorted(row, j)
+        return bool(k < len(row) and row[k] == j)
+
+    def __iter__(self):
+        sources, targets = self.arrays()
+        return zip(sources.tolist(), targets.tolist())
+
+    def __len__(self) -> int:
+        return self.matrix.nnz
+
+    def __or__(self, other):
+        if self.same_nodes(other):
+            return PairSet(self.matrix + other.matrix, self.state_map, self.int_map)
+        return super().__or__(other)
+
+    def __and__(self, other):
+        if self.same_nodes(other):
+            return PairSet(
+                self.matrix.multiply(other.matrix).tocsr(), self.state_map, self.int_map
+            )
+        return super().__and__(other)
+
+    __ror__ = __or__
+    __rand__ = __and__
 
-        matrix = dict()
-        for label in automaton.symbols:
-            matrix[label] = csr_matrix((n, n), dtype=bool)
-            for u, edges in states.items():
-                if label in edges:
-                    for v in to_set(edges[label]):
-                        matrix[label][state_map[u], state_map[v]] = True
+    def same_nodes(self, other) -> bool:
+        if not isinstance(other, PairSet):
+            return False
+        a, b = self.int_map, other.int_map
+        return a is b or len(a) == len(b) and all(x == y for x, y in zip(a, b))
 
-        return matrix, automaton.start_states, automaton.final_states, state_map
+    def arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        rows, cols = self.matrix.nonzero()
+        return node_ids(self.int_map, rows), node_ids(self.int_map, cols)
 
-    @staticmethod
-    def __to_nfa(automaton) -> NondeterministicFiniteAutomaton:
-        nfa = NondeterministicFiniteAutomaton()
-        for label in automaton.matrix.keys():
-            m_size = automaton.matrix[label].shape[0]
-            for u in range(m_size):
-                for v in range(m_size):
-                    if automaton.matrix[label][u, v]:
-                        nfa.add_transition(
-                            automaton.state_map[u], label, automaton.state_map[v]
-                        )
+    def to_set(self) -> set:
+        return set(self)
+
+
+def lookup_states(state_map, states, skip_missing: bool = False) -> np.ndarray:
+    if hasattr(state_map, "indices"):
+        return state_map.indices(states, skip_missing)
+    if skip_missing:
+        states = (s for s in states if s in state_map)
+    return np.fromiter((state_map[s] for s in states), dtype=np.int64)
 
-        for s in automaton.start:
-            nfa.add_start_state(automaton.state_map[s])
-        for s in automaton.final:
-            nfa.add_final_state(automaton.state_map[s])
 
-        return nfa
+def node_ids(int_map, indices: np.ndarray) -> np.ndarray:
+    if isinstance(int_map, np.ndarray):
+        return int_map[indices]
+    return np.fromiter(
+        (int_map[i] for i in indices.tolist()), dtype=object, count=len(indices)
+    )
+
+
+@contextmanager
+def text_output(output: Path | str | TextIO):
+    # Paths are opened and closed here, open streams are written as they are
+    if isinstance(output, (Path, str)):
+        with open(output, "w") as f:
+            yield f
+    else:
+        yield output
+
+
+def save_matrices(path: Path, matrix) -> list:
+    # Label k is stored as k.indptr.npy and k.indices.npy; the data of every
+    # label is a prefix of one shared buffer of ones
+    labels = list(matrix.keys())
+    nnz = 0
+    for k, label in enumerate(labels):
+        m = matrix[label].tocsr()
+        m.sum_duplicates()
+        np.save(path / f"{k}.indptr.npy", m.indptr)
+        np.save(path / f"{k}.indices.npy", m.indices)
+        nnz = max(nnz, m.nnz)
+    np.save(path / "ones.npy", np.ones(nnz, dtype=bool))
+    return [getattr(label, "value", label) for label in labels]
+
+
+def load_matrices(path: Path, labels, n: int, mmap_mode: str = None) -> dict:
+    ones = np.load(path / "ones.npy", mmap_mode=mmap_mode)
+    matrix = dict()
+    for k, label in enumerate(labels):
+        indptr = np.load(path / f"{k}.indptr.npy", mmap_mode=mmap_mode)
+        indices = np.load(path / f"{k}.indices.npy", mmap_mode=mmap_mode)
+        matrix[label] = csr_matrix((ones[: len(indices)], indices, indptr), (n, n))
+    return matrix
+
+
+def read_only(*arrays: np.ndarray):
+    # Cached automata, grammars and rsms are shared between callers, so what
+    # they hold is made read-only rather than trusted not to be mutated
+    for array in arrays:
+        array.flags.writeable = False
+
+
+def node_table(nodes) -> np.ndarray:
+    # Plain int or str ids get a typed array, anything else (mixed types,
+    # tuples) is kept as Python objects so it round-trips unchanged
+    if isinstance(nodes, np.ndarray) and nodes.dtype != object:
+        return nodes
+    nodes = list(nodes)
+    if all(type(v) is int for v in nodes):
+        try:
+            return np.array(nodes, dtype=np.int64)
+        except OverflowError:
+            pass
+    elif all(type(v) is str for v in nodes):
+        return np.array(nodes, dtype=str)
+    return np.fromiter(nodes, dtype=object, count=len(nodes))
+
+
+def index_array(indices=None) -> np.ndarray:
+    if indices is None:
+        return np.empty(0, dtype=np.int64)
+    if not isinstance(indices, np.ndarray):
+        indices = np.fromiter(indices, dtype=np.int64)
+    return np.unique(indices.astype(np.int64, copy=False))
+
+
+def bool_matrix(rows, cols, n: int, m: int = None) -> csr_matrix:
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    data = np.ones(len(rows), dtype=bool)
+    return coo_matrix((data, (rows, cols)), shape=(n, n if m is None else m)).tocsr()
+
+
+def product_indices(a: np.ndarray, b: np.ndarray, n: int) -> np.ndarray:
+    return (a[:, None] * n + b[None, :]).ravel()
 
 
 def intersect_automata(a: FiniteAutomaton, b: FiniteAutomaton) -> FiniteAutomaton:
     labels = {label for label in a.matrix.keys() if label in b.matrix}
-
-    automaton = FiniteAutomaton(
-        {label: kron(a.matrix[label], b.matrix[label], "csr") for label in labels}
+    n = b.size()
+
+    return FiniteAutomaton(
+        {label: kron(a.matrix[label], b.matrix[label], "csr") for label in labels},
+        product_indices(a.start, b.start, n),
+        product_indices(a.final, b.final, n),
+        IdentityStateMap(a.size() * n),
+        range(a.size() * n),
     )
 
-    for u, i in a.state_map.items():
-        for v, j in b.state_map.items():
-
-            k = len(b.state_map) * i + j
-            automaton.state_map[k] = k
 
-            if u in a.start and v in b.start:
-                automaton.start.add(k)
+CLOSURE_DENSITY_THRESHOLD = 0.01
+MULTI_SOURCE_THRESHOLD = 0.1
 
-            if u in a.final and v in b.final:
-                automaton.final.add(k)
 
-    return automaton
+def adjacency_matrix(fa: FiniteAutomaton) -> csr_matrix:
+    result = csr_matrix((fa.size(), fa.size()), dtype=bool)
+    for matrix in fa.matrix.values():
+        result += matrix
+    return result
 
 
-def transitive_closure(fa: FiniteAutomaton):
+def transitive_closure(fa: FiniteAutomaton, method: str = None):
     if fa.is_empty():
         return csr_matrix((0, 0), dtype=bool)
 
-    result = sum(fa.matrix.values()) + np.eye(fa.size(), fa.size(), dtype=bool)
+    adjacency = adjacency_matrix(fa)
+    closure = adjacency + eye(fa.size(), dtype=bool, format="csr")
+
+    if method is None:
+        dense = adjacency.nnz >= CLOSURE_DENSITY_THRESHOLD * fa.size() ** 2
+        method = "squaring" if dense else "bfs"
+    if method not in ("squaring", "bfs"):
+        raise ValueError(f"Unknown closure method: {method}")
 
-    p = 0
-    f_sparse = csr_matrix(result)
-    while True:
-        p_new = f_sparse.count_nonzero()
-        if p_new == p:
-            break
-        p = p_new
-        f_sparse += f_sparse @ f_sparse
-    return f_sparse
+    # Only pairs discovered on the previous round can produce new ones
+    delta = closure
+    while delta.nnz:
+        if method == "bfs":
+            reached = delta @ adjacency
+        else:
+            reached = delta @ closure + closure @ delta
+        delta = reached > closure
+        closure = closure + delta
+    return closure
 
 
-def paths_ends(
-    graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int], regex: str
-) -> list[tuple[NodeView, NodeView]]:
-    graph_a = FiniteAutomaton(graph_to_nfa(graph, start_nodes, final_nodes))
-    constraints_a = FiniteAutomaton(regex_to_dfa(regex))
+def multi_source_reachability(
+    fa: FiniteAutomaton, sources, adjacency: csr_matrix = None
+) -> csr_matrix:
+    sources = np.asarray(sources, dtype=np.int64)
+    adjacency = adjacency_matrix(fa) if adjacency is None else adjacency
+
+    # Row i holds every state reachable from sources[i], itself included
+    visited = bool_matrix(np.arange(len(sources)), sources, len(sources), fa.size())
+    front = visited
+    while front.nnz:
+        front = (front @ adjacency) > visited
+        visited = visited + front
+    return visited
+
+
+regex_cache = LRUCache(maxsize=256)
+
+
+def regex_to_fa(regex: str) -> FiniteAutomaton:
+    return regex_cache.get(
+        " ".join(regex.split()),
+        lambda: FiniteAutomaton(regex_to_dfa(regex)).freeze(),
+    )
+
+
+def prepare_graph(graph: MultiDiGraph | Path | str) -> FiniteAutomaton:
+    # Encode the graph once, queries then only swap start/final masks
+    if isinstance(graph, MultiDiGraph):
+        return FiniteAutomaton.from_graph(graph)
+    return FiniteAutomaton.from_csv(graph)
 
-    intersected = intersect_automata(graph_a, constraints_a)
-    tc = transitive_closure(intersected)
 
+def graph_automaton(
+    graph: MultiDiGraph | FiniteAutomaton, start_nodes=None, final_nodes=None
+) -> FiniteAutomaton:
+    if isinstance(graph, FiniteAutomaton):
+        return graph.with_states(start_nodes, final_nodes)
+    return FiniteAutomaton.from_graph(graph, start_nodes, final_nodes)
+
+
+def graph_nodes(graph: MultiDiGraph | FiniteAutomaton):
+    if isinstance(graph, FiniteAutomaton):
+        return list(graph.int_map)
+    return graph.nodes
+
+
+PATHS_CHUNK_SIZE = 1024
+
+
+def paths_ends_chunks(
+    graph: MultiDiGraph | FiniteAutomaton,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    regex: str,
+    chunk_size: int = PATHS_CHUNK_SIZE,
+):
+    graph_a = graph_automaton(graph, start_nodes, final_nodes)
+    constraints_a = regex_to_fa(regex)
+
+    intersected = intersect_automata(graph_a, constraints_a)
+    if intersected.is_empty():
+        return
+
+    # Few sources are searched from directly, one chunk at a time; for many
+    # sources a single closure is cheaper and chunks are its row slices
+    sources = intersected.start
+    closure = None
+    if len(sources) > MULTI_SOURCE_THRESHOLD * intersected.size():
+        closure = transitive_closure(intersected)
+    else:
+        adjacency = adjacency_matrix(intersected)
+
+    # Sources are sorted, so each graph node owns a contiguous run of them and
+    # splitting between runs keeps every pair inside a single chunk
     size = constraints_a.size()
-    result = set()
-    for u, v in zip(*tc.nonzero()):
-        if u in intersected.start and v in intersected.final:
-            result.add((graph_a.state_map[u // size], graph_a.state_map[v // size]))
+    n = graph_a.size()
+    owners = sources // size
+    runs = np.flatnonzero(np.diff(owners)) + 1
+    splits = runs[chunk_size - 1 :: chunk_size]
+    for lo, hi in zip(np.r_[0, splits], np.r_[splits, len(sources)]):
+        if closure is None:
+            reachable = multi_source_reachability(
+                intersected, sources[lo:hi], adjacency
+            )
+        else:
+            reachable = closure[sources[lo:hi]]
+        rows, cols = reachable.nonzero()
+        keep = intersected.final_mask[cols]
+        codes = np.unique(owners[rows[keep] + lo] * n + cols[keep] // size)
+        if len(codes):
+            yield graph_a.node_ids(codes // n), graph_a.node_ids(codes % n)
 
-    if len(constraints_a.start & constraints_a.final) > 0:
-        result |= {(i, i) for i in start_nodes & final_nodes}
 
-    return list(result)
+def paths_ends(
+    graph: MultiDiGraph | FiniteAutomaton,
+    start_nodes: set[int],
+    final_nodes: set[int],
+    regex: str,
+) -> list[tuple[NodeView, NodeView]]:
+    result = []
+    for sources, targets in paths_ends_chunks(graph, start_nodes, final_nodes, regex):
+        result.extend(zip(sources.tolist(), targets.tolist()))
+    return result
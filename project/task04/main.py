@@ -1,63 +1,98 @@
-from project.task03 import FiniteAutomaton
-from scipy.sparse import csr_matrix, block_diag
-
-
-def bfs_front(m):
-    h = m.shape[0]
-    res = csr_matrix(m.shape, dtype=bool)
-    for i in range(h):
-        for j in range(h):
-            if m[j, i]:
-                res[i] += m[j]
-    return res
+import numpy as np
+from networkx import MultiDiGraph
+from project.task03 import FiniteAutomaton, graph_automaton
+from project.task03.main import bool_matrix, product_indices
+from scipy.sparse import csr_matrix, block_diag, diags, hstack
+
+
+def bfs_front(m, height=None):
+    # Row j of block b lands under every constraint state i it has reached,
+    # i.e. res[b * height + i] |= m[j]
+    h = m.shape[0] if height is None else height
+    rows, cols = m[:, :h].nonzero()
+    move = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows - rows % h + cols, rows)),
+        shape=(m.shape[0], m.shape[0]),
+    )
+    return csr_matrix(move @ m, dtype=bool)
+
+
+def stacked_front(starts, constraint_starts, m, n):
+    rows = product_indices(np.arange(len(starts)), constraint_starts, m)
+    left = np.tile(constraint_starts, len(starts))
+    right = np.repeat(starts, len(constraint_starts)) + m
+
+    return bool_matrix(
+        np.concatenate((rows, rows)),
+        np.concatenate((left, right)),
+        len(starts) * m,
+        m + n,
+    )
 
 
 def reachability_with_constraints(
-    fa: FiniteAutomaton, constraints_fa: FiniteAutomaton
-) -> dict[int, set[int]]:
+    fa: FiniteAutomaton | MultiDiGraph,
+    constraints_fa: FiniteAutomaton,
+    batch_size: int = None,
+    return_iterations: bool = False,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+) -> dict[int, set[int]] | tuple[dict[int, set[int]], int]:
+    retarget = start_nodes is not None or final_nodes is not None
+    if retarget or not isinstance(fa, FiniteAutomaton):
+        fa = graph_automaton(fa, start_nodes, final_nodes)
 
     matrices = {}
 
     labels = fa.matrix.keys() & constraints_fa.matrix.keys()
-    m, n = len(constraints_fa.int_map), len(fa.int_map)
+    m, n = constraints_fa.size(), fa.size()
 
     for label in labels:
-        matrices[label] = block_diag((constraints_fa.matrix[label], fa.matrix[label]))
-
-    height = m
-    width = m + n
+        matrices[label] = block_diag(
+            (constraints_fa.matrix[label], fa.matrix[label]), format="csr"
+        )
 
-    res = {s.value: set() for s in fa.int_map}
+    res = {s: set() for s in fa.int_map}
 
     fa_start_states = fa.start_indices()
-    fa_final_states = fa.final_indices()
     cfa_start_states = constraints_fa.start_indices()
-    cfa_final_states = constraints_fa.final_indices()
 
-    for start in fa_start_states:
-        front = csr_matrix((height, width), dtype=bool)
+    iterations = 0
+    batch_size = max(1, len(fa_start_states) if batch_size is None else batch_size)
+    for b in range(0, len(fa_start_states), batch_size):
+        starts = fa_start_states[b : b + batch_size]
+
+        # One block of m rows per start vertex, advanced by a single multiply
+        front = stacked_front(starts, cfa_start_states, m, n)
+        visited = front
+        while front.nnz:
+            iterations += 1
+            new_front = csr_matrix(front.shape, dtype=bool)
+            for label in labels:
+                new_front += bfs_front(front @ matrices[label], m)
 
-        for constraint in cfa_start_states:
-            front[constraint, constraint] = True
+            # Already visited graph states were expanded on an earlier round,
+            # rows keep their constraint state as long as they have new ones
+            new = csr_matrix((new_front > visited)[:, m:])
+            active = diags(np.diff(new.indptr) > 0, dtype=bool)
+            front = hstack((active @ new_front[:, :m], new), format="csr")
+            visited = visited + front
 
-        for i in range(height):
-            front[i, start + m] = True
+        rows, cols = visited.nonzero()
+        blocks, states = np.divmod(rows, m)
 
-        if start in fa_final_states:
-            for i in cfa_start_states:
-                if i in cfa_final_states:
-                    res[fa.int_map[start]].add(fa.int_map[start])
-                    break
+        # As with front[i, i], a row only counts under the constraint state
+        # it has reached
+        live = np.zeros(visited.shape[0], dtype=bool)
+        live[rows[cols == states]] = True
 
-        for _ in range(m * n):
-            new_front = csr_matrix((height, width), dtype=bool)
-            for label in labels:
-                new_front += bfs_front(front @ matrices[label])
-            front = new_front
-
-            for i in range(height):
-                if i in cfa_final_states and front[i, i]:
-                    for j in range(n):
-                        if j in fa_final_states and front[i, j + m]:
-                            res[fa.int_map[start]].add(fa.int_map[j])
+        keep = (cols >= m) & live[rows] & constraints_fa.final_mask[states]
+        keep[keep] = fa.final_mask[cols[keep] - m]
+
+        int_map = fa.int_map
+        for u, v in zip(starts[blocks[keep]].tolist(), (cols[keep] - m).tolist()):
+            res[int_map[u]].add(int_map[v])
+
+    if return_iterations:
+        return res, iterations
     return res
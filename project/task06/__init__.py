@@ -1,3 +1,13 @@
-from project.task06.main import cfg_to_weak_normal_form, cfpq_with_hellings
+from project.task06.main import (
+    CompiledGrammar,
+    cfg_to_weak_normal_form,
+    cfpq_with_hellings,
+    compile_grammar,
+)
 
-__all__ = [cfg_to_weak_normal_form, cfpq_with_hellings]
+__all__ = [
+    CompiledGrammar,
+    cfg_to_weak_normal_form,
+    cfpq_with_hellings,
+    compile_grammar,
+]
@@ -1,4 +1,10 @@
-from pyformlang.cfg import CFG, Variable, Terminal, Epsilon
+from types import MappingProxyType
+
+from pyformlang.cfg import CFG, Terminal
+import numpy as np
+
+from project.task03 import PairSet, graph_automaton
+from project.task03.main import LRUCache
 
 
 def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
@@ -11,59 +17,114 @@ def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
     )
 
 
+class CompiledGrammar:
+
+    def __init__(self, cfg: CFG):
+        self.cfg = cfg_to_weak_normal_form(cfg)
+
+        # Nonterminals are interned to dense ids, the start symbol gets 0
+        self.ids = {cfg.start_symbol: 0}
+        self.start = 0
+        self.P_epsilon = []
+        self.P_terminal = {}
+        self.P_mult = {}
+
+        ids = self.ids
+        for p in dict.fromkeys(self.cfg.productions):
+            head = ids.setdefault(p.head, len(ids))
+            if len(p.body) == 0:
+                self.P_epsilon.append(head)
+            elif len(p.body) == 1 and isinstance(p.body[0], Terminal):
+                self.P_terminal.setdefault(p.body[0].value, []).append(head)
+            elif len(p.body) == 2:
+                body = tuple(ids.setdefault(symbol, len(ids)) for symbol in p.body)
+                self.P_mult.setdefault(body, []).append(head)
+
+        self.ids = MappingProxyType(ids)
+        self.P_epsilon = tuple(self.P_epsilon)
+        self.P_terminal = MappingProxyType(
+            {label: tuple(heads) for label, heads in self.P_terminal.items()}
+        )
+        self.P_mult = MappingProxyType(
+            {body: tuple(heads) for body, heads in self.P_mult.items()}
+        )
+
+    def size(self) -> int:
+        return len(self.ids)
+
+
+def grammar_fingerprint(cfg: CFG) -> tuple:
+    productions = (" ".join(map(repr, [p.head, *p.body])) for p in cfg.productions)
+    return repr(cfg.start_symbol), tuple(sorted(set(productions)))
+
+
+grammar_cache = LRUCache(maxsize=64)
+
+
+def compile_grammar(cfg: CFG | CompiledGrammar) -> CompiledGrammar:
+    if isinstance(cfg, CompiledGrammar):
+        return cfg
+    return grammar_cache.get(grammar_fingerprint(cfg), lambda: CompiledGrammar(cfg))
+
+
 # https://jhellings.nl/files/icdt2014_paper.pdf
 def cfpq_with_hellings(
-    cfg,
+    cfg: CFG | CompiledGrammar,
     graph,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
-    start_nodes = graph.nodes if start_nodes is None else start_nodes
-    final_nodes = graph.nodes if final_nodes is None else final_nodes
-
-    P_terminal = {}
-    P_epsilon = set()
-    P_mult = {}
-
-    for p in cfg_to_weak_normal_form(cfg).productions:
-        if len(p.body) == 0:
-            P_epsilon.add(p.head)
-        elif len(p.body) == 1 and isinstance(p.body[0], Terminal):
-            P_terminal.setdefault(p.head, set()).add(p.body[0])
-        elif len(p.body) == 2:
-            P_mult.setdefault(p.head, set()).add((p.body[0], p.body[1]))
-
-    r = {(N, n, n) for N in P_epsilon for n in graph.nodes} | {
-        (N, n, m)
-        for (n, m, tag) in graph.edges.data("label")
-        for N in P_terminal
-        if Terminal(tag) in P_terminal[N]
-    }
-
-    new = r.copy()
+    compact: bool = False,
+) -> set[tuple[int, int]] | PairSet:
+    fa = graph_automaton(graph)
+    n = fa.size()
+
+    grammar = compile_grammar(cfg)
+    P_terminal = grammar.P_terminal
+    P_epsilon = grammar.P_epsilon
+    P_mult = grammar.P_mult
+
+    # A triple (N, u, v) is packed as (N * n + u) * n + v, r is indexed by
+    # end node and by start node so a popped triple only meets the triples it
+    # can be concatenated with
+    r = set()
+    ending = [set() for _ in range(n)]
+    starting = [set() for _ in range(n)]
+    new = []
+
+    def add(N, u, v):
+        key = (N * n + u) * n + v
+        if key not in r:
+            r.add(key)
+            ending[v].add(N * n + u)
+            starting[u].add(N * n + v)
+            new.append(key)
+
+    for N in P_epsilon:
+        for u in range(n):
+            add(N, u, u)
+    for label, matrix in fa.matrix.items():
+        heads = P_terminal.get(label, ())
+        if heads:
+            rows, cols = matrix.nonzero()
+            for u, v in zip(rows.tolist(), cols.tolist()):
+                for N in heads:
+                    add(N, u, v)
 
     while new:
-        N, n, m = new.pop()
-        to_add = set()
-        for M, np, n_ in r:
-            if n == n_:
-                for Np in P_mult:
-                    if (M, N) in P_mult[Np]:
-                        if (Np, np, m) not in r:
-                            new.add((Np, np, m))
-                            to_add.add((Np, np, m))
-
-        for M, m_, mp in r:
-            if m == m_:
-                for Mp in P_mult:
-                    if (N, M) in P_mult[Mp]:
-                        if (Mp, n, mp) not in r:
-                            new.add((Mp, n, mp))
-                            to_add.add((Mp, n, mp))
-        r |= to_add
-
-    return {
-        (n, m)
-        for (N, n, m) in r
-        if n in start_nodes and m in final_nodes and Variable(N) == cfg.start_symbol
-    }
+        Nu, v = divmod(new.pop(), n)
+        N, u = divmod(Nu, n)
+        for Mw in list(ending[u]):
+            M, w = divmod(Mw, n)
+            for head in P_mult.get((M, N), ()):
+                add(head, w, v)
+        for Mw in list(starting[v]):
+            M, w = divmod(Mw, n)
+            for head in P_mult.get((N, M), ()):
+                add(head, u, w)
+
+    keys = np.fromiter(r, dtype=np.int64, count=len(r))
+    keys = keys[keys < n * n]
+    rows, cols = keys // n, keys % n
+    keep = fa.node_mask(start_nodes)[rows] & fa.node_mask(final_nodes)[cols]
+    result = PairSet.from_indices(rows[keep], cols[keep], fa)
+    return result if compact else result.to_set()
@@ -1,3 +1,3 @@
-from project.task07.main import cfpq_with_matrix
+from project.task07.main import GrammarPlan, cfpq_with_matrix
 
-__all__ = [cfpq_with_matrix]
+__all__ = [GrammarPlan, cfpq_with_matrix]
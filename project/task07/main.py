@@ -1,61 +1,110 @@
-from pyformlang.cfg import Terminal
+from types import MappingProxyType
+
+from pyformlang.cfg import CFG
 from scipy.sparse import csr_matrix
-from copy import deepcopy
+import networkx as nx
+
+from project.task03 import PairSet, graph_automaton
+from project.task03.main import LRUCache
+from project.task06 import CompiledGrammar, compile_grammar
+
+
+class GrammarPlan:
+
+    def __init__(self, cfg: CFG | CompiledGrammar):
+        grammar = compile_grammar(cfg)
+        self.ids = grammar.ids
+        self.start = grammar.start
+        self.epsilon = grammar.P_epsilon
+        self.terminal = grammar.P_terminal
+
+        dependencies = nx.DiGraph()
+        dependencies.add_nodes_from(range(len(self.ids)))
+        for (L, R), heads in grammar.P_mult.items():
+            dependencies.add_edges_from((M, N) for M in (L, R) for N in heads)
+
+        # Components in topological order, each with its productions grouped by
+        # body; only recursive ones need a fixpoint
+        condensation = nx.condensation(dependencies)
+        components = []
+        for c in nx.topological_sort(condensation):
+            members = condensation.nodes[c]["members"]
+            bodies = {}
+            for body, heads in grammar.P_mult.items():
+                heads = tuple(N for N in heads if N in members)
+                if heads:
+                    bodies[body] = heads
+            recursive = len(members) > 1 or any(
+                dependencies.has_edge(N, N) for N in members
+            )
+            if bodies:
+                components.append((MappingProxyType(bodies), recursive))
+        self.components = tuple(components)
 
-from project.task06 import cfg_to_weak_normal_form
+    def size(self) -> int:
+        return len(self.ids)
+
+
+plan_cache = LRUCache(maxsize=64)
+
+
+def grammar_plan(cfg: CFG | CompiledGrammar | GrammarPlan) -> GrammarPlan:
+    if isinstance(cfg, GrammarPlan):
+        return cfg
+    grammar = compile_grammar(cfg)
+    return plan_cache.get(grammar, lambda: GrammarPlan(grammar))
 
 
 def cfpq_with_matrix(
-    cfg,
+    cfg: CFG | CompiledGrammar | GrammarPlan,
     graph,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
-    start_nodes = graph.nodes if start_nodes is None else start_nodes
-    final_nodes = graph.nodes if final_nodes is None else final_nodes
-
-    cfg = cfg_to_weak_normal_form(cfg)
-    n = len(graph.nodes)
-    products = {p.head.value: csr_matrix((n, n), dtype=bool) for p in cfg.productions}
-    accumulate = deepcopy(products)
-
-    P_epsilon = set()
-    P_terminal = {}
-    P_mult = {}
-
-    for p in cfg.productions:
-        if len(p.body) == 0:
-            P_epsilon.add(p.head.value)
-        elif len(p.body) == 1 and isinstance(p.body[0], Terminal):
-            P_terminal.setdefault(p.body[0].value, set()).add(p.head.value)
-        elif len(p.body) == 2:
-            P_mult.setdefault(p.head.value, set()).add(
-                (p.body[0].value, p.body[1].value)
-            )
+    compact: bool = False,
+) -> set[tuple[int, int]] | PairSet:
+    fa = graph_automaton(graph)
+    plan = grammar_plan(cfg)
+    n = fa.size()
+    products = [csr_matrix((n, n), dtype=bool) for _ in range(plan.size())]
 
-    for n, m, tag in graph.edges.data("label"):
-        if tag in P_terminal:
-            for N in P_terminal[tag]:
-                products[N][n, m] = True
+    for tag, matrix in fa.matrix.items():
+        for N in plan.terminal.get(tag, ()):
+            products[N] += matrix
 
-    for N in P_epsilon:
+    for N in plan.epsilon:
         products[N].setdiag(True)
 
-    new = True
-    while new:
-        new = False
-        for N, mult in P_mult.items():
-            prev = accumulate[N].nnz
-            for L, R in mult:
-                accumulate[N] += products[L] @ products[R]
-            new |= prev != accumulate[N].nnz
-        if new:
-            for N, m in accumulate.items():
-                products[N] += m
-
-    start = cfg.start_symbol.value
-    return {
-        (n, m)
-        for n, m in zip(*products[start].nonzero())
-        if n in start_nodes and m in final_nodes
-    }
+    for bodies, recursive in plan.components:
+        # Semi-naive: after the first pass only pairs found on the previous
+        # round are multiplied, operands outside the component are final
+        delta = None
+        while True:
+            reached = {}
+            for (L, R), heads in bodies.items():
+                if delta is None:
+                    parts = [products[L] @ products[R]]
+                else:
+                    parts = []
+                    if L in delta:
+                        parts.append(delta[L] @ products[R])
+                    if R in delta:
+                        parts.append(products[L] @ delta[R])
+                for N in heads:
+                    reached.setdefault(N, []).extend(parts)
+
+            delta = {}
+            for N, parts in reached.items():
+                if not parts:
+                    continue
+                new = sum(parts[1:], parts[0]) > products[N]
+                if new.nnz:
+                    products[N] = products[N] + new
+                    delta[N] = new
+
+            if not recursive or not delta:
+                break
+
+    rows, cols = products[plan.start].nonzero()
+    keep = fa.node_mask(start_nodes)[rows] & fa.node_mask(final_nodes)[cols]
+    result = PairSet.from_indices(rows[keep], cols[keep], fa)
+    return result if compact else result.to_set()
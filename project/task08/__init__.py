@@ -1,3 +1,9 @@
-from project.task08.main import cfpq_with_tensor, cfg_to_rsm, ebnf_to_rsm
+from project.task08.main import (
+    CompiledRsm,
+    cfpq_with_tensor,
+    cfg_to_rsm,
+    ebnf_to_rsm,
+    rsm_to_mat,
+)
 
-__all__ = [cfpq_with_tensor, cfg_to_rsm, ebnf_to_rsm]
+__all__ = [CompiledRsm, cfpq_with_tensor, cfg_to_rsm, ebnf_to_rsm, rsm_to_mat]
@@ -1,80 +1,200 @@
+from pathlib import Path
+from types import MappingProxyType
+import json
+
 from pyformlang.rsa import RecursiveAutomaton
 from pyformlang.cfg import CFG
 
 import networkx as nx
+import numpy as np
 from scipy.sparse import csr_matrix, kron, eye
-from itertools import product
 
-from project.task02 import graph_to_nfa
-from project.task03 import FiniteAutomaton
+from project.task03 import FiniteAutomaton, PairSet, graph_automaton
+from project.task03.main import (
+    LRUCache,
+    bool_matrix,
+    load_matrices,
+    read_only,
+    save_matrices,
+)
+from project.task06.main import grammar_fingerprint
+
+
+class CompiledRsm:
+
+    def __init__(self, matrix, boxes, offsets, start_mask, final_mask, initial):
+        # Box k owns the contiguous states offsets[k] : offsets[k + 1]
+        for m in matrix.values():
+            read_only(m.data, m.indices, m.indptr)
+        self.matrix = MappingProxyType(dict(matrix))
+        self.boxes = tuple(boxes)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.start_mask = np.array(start_mask, dtype=bool)
+        self.final_mask = np.array(final_mask, dtype=bool)
+        self.initial = initial
+        self.box = np.repeat(np.arange(len(boxes)), np.diff(self.offsets))
+        read_only(self.offsets, self.start_mask, self.final_mask, self.box)
+
+    @classmethod
+    def from_rsm(cls, rsm: RecursiveAutomaton) -> "CompiledRsm":
+        boxes = sorted(rsm.boxes.items(), key=lambda item: str(item[0].value))
+
+        index = {}
+        offsets = [0]
+        for sym, box in boxes:
+            # pyformlang state names depend on set order, so states are numbered
+            # by a breadth-first walk over labels in sorted order instead
+            dfa = box.dfa
+            transitions = dfa.to_dict()
+            order = list(dfa.start_states)
+            for state in order:
+                edges = transitions.get(state, {})
+                for symbol in sorted(edges, key=lambda symbol: str(symbol.value)):
+                    if edges[symbol] not in order:
+                        order.append(edges[symbol])
+            order += sorted(set(dfa.states) - set(order), key=str)
+            for state in order:
+                index[(sym.value, state.value)] = len(index)
+            offsets.append(len(index))
+
+        n = len(index)
+        start = np.zeros(n, dtype=bool)
+        final = np.zeros(n, dtype=bool)
+        edges = {}
+        for sym, box in boxes:
+            dfa = box.dfa
+            start[[index[(sym.value, state.value)] for state in dfa.start_states]] = (
+                True
+            )
+            final[[index[(sym.value, state.value)] for state in dfa.final_states]] = (
+                True
+            )
+            for from_state, transitions in dfa.to_dict().items():
+                for symbol, to_state in transitions.items():
+                    rows, cols = edges.setdefault(symbol.value, ([], []))
+                    rows.append(index[(sym.value, from_state.value)])
+                    cols.append(index[(sym.value, to_state.value)])
+
+        matrix = {
+            label: bool_matrix(rows, cols, n)
+            for label, (rows, cols) in sorted(edges.items(), key=lambda e: str(e[0]))
+        }
+        return cls(
+            matrix,
+            [sym.value for sym, _ in boxes],
+            offsets,
+            start,
+            final,
+            rsm.initial_label.value,
+        )
+
+    def size(self) -> int:
+        return int(self.offsets[-1])
+
+    def save(self, path: Path | str):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        labels = save_matrices(path, self.matrix)
+
+        np.save(path / "offsets.npy", self.offsets)
+        np.save(path / "start_mask.npy", self.start_mask)
+        np.save(path / "final_mask.npy", self.final_mask)
+
+        meta = {"initial": self.initial, "boxes": list(self.boxes), "labels": labels}
+        with open(path / "meta.json", "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path: Path | str) -> "CompiledRsm":
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+
+        offsets = np.load(path / "offsets.npy")
+        return cls(
+            load_matrices(path, meta["labels"], int(offsets[-1])),
+            meta["boxes"],
+            offsets,
+            np.load(path / "start_mask.npy"),
+            np.load(path / "final_mask.npy"),
+            meta["initial"],
+        )
 
 
 def cfpq_with_tensor(
-    rsm: RecursiveAutomaton | CFG,
-    graph: nx.DiGraph,
+    rsm: RecursiveAutomaton | CFG | CompiledRsm,
+    graph: nx.DiGraph | FiniteAutomaton,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
-    if isinstance(rsm, CFG):
-        rsm = cfg_to_rsm(rsm)
-
-    start_nodes = graph.nodes if start_nodes is None else start_nodes
-    final_nodes = graph.nodes if final_nodes is None else final_nodes
-
-    fa = FiniteAutomaton(graph_to_nfa(graph, start_nodes, final_nodes))
-    matrix, state_map, n_graph, int_map = (
-        fa.matrix,
-        fa.state_map,
-        len(fa.int_map),
-        fa.int_map,
-    )
-
-    rsm_matrix, n_rsm, rsm_state, rsm_start, rsm_final = rsm_to_mat(rsm)
-
-    idx_to_state = {i: state for i, state in enumerate(product(int_map, rsm_state))}
-
-    old = 0
+    compact: bool = False,
+) -> set[tuple[int, int]] | PairSet:
+    fa = graph_automaton(graph, start_nodes, final_nodes)
+    rsm = rsm_to_mat(rsm)
+
+    # Product index i is graph state i // n_rsm and rsm state i % n_rsm
+    n_graph = fa.size()
+    n_rsm = rsm.size()
+    rsm_matrix, boxes, rsm_box = rsm.matrix, rsm.boxes, rsm.box
+    rsm_start, rsm_final = rsm.start_mask, rsm.final_mask
+
+    # The closure is kept between rounds, each round only explores the paths
+    # that go through the edges found on the previous one
+    matrix = dict(fa.matrix)
     n = n_rsm * n_graph
+    closure = eye(n, dtype=bool, format="csr")
+    new = closure
+    delta = {symbol: matrix[symbol] for symbol in rsm_matrix.keys() & matrix.keys()}
     while True:
-        symbols = rsm_matrix.keys() & matrix.keys()
-        m = csr_matrix((n, n), dtype=bool) + eye(n, dtype=bool)
-        if len(symbols) != 0:
-            for symbol in symbols:
-                m += kron(matrix[symbol], rsm_matrix[symbol])
-
-        maybe_new = True
-        maybe_old = m.nnz
-        while maybe_new:
-            m += m @ m
-            maybe_new = maybe_old != m.nnz
-            maybe_old = m.nnz
-
-        if maybe_old == old:
+        rows, cols = new.nonzero()
+        keep = rsm_start[rows % n_rsm] & rsm_final[cols % n_rsm]
+        rows, cols = rows[keep], cols[keep]
+        found = rsm_box[rows % n_rsm]
+        rows, cols = rows // n_rsm, cols // n_rsm
+
+        for b in np.unique(found).tolist():
+            sym = boxes[b]
+            edges = bool_matrix(rows[found == b], cols[found == b], n_graph)
+            if sym in matrix:
+                edges = edges > matrix[sym]
+                matrix[sym] = matrix[sym] + edges
+            else:
+                matrix[sym] = edges
+            if edges.nnz and sym in rsm_matrix:
+                delta[sym] = delta[sym] + edges if sym in delta else edges
+
+        if not delta:
             break
-        old = maybe_old
-
-        for from_idx, to_idx in zip(*m.nonzero()):
-            from_graph_state, from_rsm_state = idx_to_state[from_idx]
-            to_graph_state, to_rsm_state = idx_to_state[to_idx]
-            if from_rsm_state in rsm_start and to_rsm_state in rsm_final:
-                sym = from_rsm_state[0]
-                from_graph_idx = state_map[from_graph_state]
-                to_graph_idx = state_map[to_graph_state]
-                matrix.setdefault(sym, csr_matrix((n_graph, n_graph), dtype=bool))[
-                    from_graph_idx, to_graph_idx
-                ] = True
-
-    res = set()
-    start = rsm.initial_label.value
-    if start not in matrix:
-        return res
-
-    for from_graph_state, to_graph_state in product(start_nodes, final_nodes):
-        from_graph_idx = state_map[from_graph_state]
-        to_graph_idx = state_map[to_graph_state]
-        if matrix[start][from_graph_idx, to_graph_idx]:
-            res.add((from_graph_state, to_graph_state))
-    return res
+
+        step = csr_matrix((n, n), dtype=bool)
+        for symbol, edges in delta.items():
+            step += kron(edges, rsm_matrix[symbol], "csr")
+        step = step @ closure
+        delta = {}
+
+        old = closure
+        front = closure @ step
+        while True:
+            front = front > closure
+            if not front.nnz:
+                break
+            closure = closure + front
+            front = front @ step
+        new = closure > old
+
+    start = rsm.initial
+    empty = any(
+        nodes is not None and len(nodes) == 0 for nodes in (start_nodes, final_nodes)
+    )
+    if start in matrix and not empty:
+        rows, cols = matrix[start].nonzero()
+        keep = fa.start_mask[rows] & fa.final_mask[cols]
+        rows, cols = rows[keep], cols[keep]
+    else:
+        rows = cols = np.empty(0, dtype=np.int64)
+
+    result = PairSet.from_indices(rows, cols, fa)
+    return result if compact else result.to_set()
 
 
 def cfg_to_rsm(cfg: CFG) -> RecursiveAutomaton:
@@ -85,28 +205,37 @@ def ebnf_to_rsm(ebnf: str) -> RecursiveAutomaton:
     return RecursiveAutomaton.from_text(ebnf)
 
 
-def rsm_to_mat(
-    rsm: RecursiveAutomaton,
-) -> tuple[dict[str, csr_matrix], int, set, set, set]:
-    n = sum([len(box.dfa.states) for box in rsm.boxes.values()])
-
-    rsm_state = set()
-    rsm_start = set()
-    rsm_final = set()
+def rsm_fingerprint(rsm: RecursiveAutomaton) -> tuple:
+    boxes = []
     for sym, box in rsm.boxes.items():
-        rsm_state |= {(sym.value, state.value) for state in box.dfa.states}
-        rsm_start |= {(sym.value, state.value) for state in box.dfa.start_states}
-        rsm_final |= {(sym.value, state.value) for state in box.dfa.final_states}
-
-    rsm_matrix = {}
-    state_map = {state: i for i, state in enumerate(rsm_state)}
-    for sym, box in rsm.boxes.items():
-        for from_state, transitions in box.dfa.to_dict().items():
-            for symbol, to_state in transitions.items():
-                from_idx = state_map[(sym.value, from_state.value)]
-                to_idx = state_map[(sym.value, to_state.value)]
-                rsm_matrix.setdefault(symbol.value, csr_matrix((n, n), dtype=bool))[
-                    from_idx, to_idx
-                ] = True
-
-    return rsm_matrix, n, rsm_state, rsm_start, rsm_final
+        dfa = box.dfa
+        transitions = (
+            f"{from_state.value!r} {symbol.value!r} {to_state.value!r}"
+            for from_state, edges in dfa.to_dict().items()
+            for symbol, to_state in edges.items()
+        )
+        boxes.append(
+            (
+                repr(sym.value),
+                tuple(sorted(repr(state.value) for state in dfa.start_states)),
+                tuple(sorted(repr(state.value) for state in dfa.final_states)),
+                tuple(sorted(transitions)),
+            )
+        )
+    return repr(rsm.initial_label.value), tuple(sorted(boxes))
+
+
+rsm_cache = LRUCache(maxsize=64)
+
+
+def rsm_to_mat(rsm: RecursiveAutomaton | CFG | CompiledRsm) -> CompiledRsm:
+    if isinstance(rsm, CompiledRsm):
+        return rsm
+    if isinstance(rsm, CFG):
+        return rsm_cache.get(
+            ("cfg", grammar_fingerprint(rsm)),
+            lambda: CompiledRsm.from_rsm(cfg_to_rsm(rsm)),
+        )
+    return rsm_cache.get(
+        ("rsm", rsm_fingerprint(rsm)), lambda: CompiledRsm.from_rsm(rsm)
+    )
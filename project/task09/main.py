@@ -1,19 +1,42 @@
+from array import array
 from copy import deepcopy
+import numpy as np
 import networkx as nx
 from pyformlang.cfg import CFG
 from pyformlang.rsa import RecursiveAutomaton
+from project.task03 import FiniteAutomaton, PairSet, graph_automaton, graph_nodes
 from project.task08 import cfg_to_rsm
 
 
+def outgoing_edges(graph: nx.DiGraph | FiniteAutomaton, node) -> dict:
+    outgoing = {}
+    if isinstance(graph, FiniteAutomaton):
+        i = graph.state_map[node]
+        for label, matrix in graph.matrix.items():
+            targets = matrix.indices[matrix.indptr[i] : matrix.indptr[i + 1]]
+            if len(targets):
+                outgoing.setdefault(getattr(label, "value", label), set()).update(
+                    graph.int_map[j] for j in targets.tolist()
+                )
+        return outgoing
+
+    for _, neighbor, label in graph.edges(node, data="label"):
+        outgoing.setdefault(label, set()).add(neighbor)
+    return outgoing
+
+
 def cfpq_with_gll(
     rsm: RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | FiniteAutomaton,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
-) -> set[tuple[int, int]]:
+    compact: bool = False,
+) -> set[tuple[int, int]] | PairSet:
     rsm = cfg_to_rsm(rsm) if isinstance(rsm, CFG) else rsm
-    start_nodes = start_nodes if start_nodes is not None else set(graph.nodes)
-    final_nodes = final_nodes if final_nodes is not None else set(graph.nodes)
+    # Nodes outside the graph can not be on any path and are skipped
+    nodes = set(graph_nodes(graph))
+    start_nodes = nodes if start_nodes is None else nodes & set(start_nodes)
+    final_nodes = nodes if final_nodes is None else nodes & set(final_nodes)
 
     initial_label = (
         rsm.initial_label.value if rsm.initial_label.value is not None else "S"
@@ -32,6 +55,9 @@ def cfpq_with_gll(
     queue = deepcopy(visited_states)
 
     popped_states = {}
+    # Compact results are collected as node indices, never as a set of tuples
+    fa = graph_automaton(graph) if compact else None
+    sources, targets = array("q"), array("q")
     result_pairs = set()
 
     while queue:
@@ -39,7 +65,11 @@ def cfpq_with_gll(
 
         if automaton_state[1] in rsm.boxes[automaton_state[0]].dfa.final_states:
             if stack_state in start_states and graph_node in final_nodes:
-                result_pairs.add((stack_state[1], graph_node))
+                if compact:
+                    sources.append(fa.state_map[stack_state[1]])
+                    targets.append(fa.state_map[graph_node])
+                else:
+                    result_pairs.add((stack_state[1], graph_node))
             popped_states.setdefault(stack_state, set()).add(graph_node)
             for previous_stack_state, previous_automaton_state in state_graph.get(
                 stack_state, set()
@@ -49,19 +79,15 @@ def cfpq_with_gll(
                     queue.add(new_state)
                     visited_states.add(new_state)
 
-        outgoing_edges = {}
-        for _, neighbor, label in graph.edges(graph_node, data="label"):
-            if label not in outgoing_edges:
-                outgoing_edges[label] = set()
-            outgoing_edges[label].add(neighbor)
+        outgoing = outgoing_edges(graph, graph_node)
 
         transitions = (
             rsm.boxes[automaton_state[0]].dfa.to_dict().get(automaton_state[1], {})
         )
         for symbol, to_state in transitions.items():
             if symbol not in rsm.labels:
-                if symbol.value in outgoing_edges:
-                    for next_node in outgoing_edges[symbol.value]:
+                if symbol.value in outgoing:
+                    for next_node in outgoing[symbol.value]:
                         new_state = (
                             next_node,
                             (automaton_state[0], to_state.value),
@@ -95,4 +121,10 @@ def cfpq_with_gll(
                     queue.add(new_state)
                     visited_states.add(new_state)
 
+    if compact:
+        return PairSet.from_indices(
+            np.frombuffer(sources, dtype=np.int64),
+            np.frombuffer(targets, dtype=np.int64),
+            fa,
+        )
     return result_pairs
@@ -33,6 +33,18 @@ def test_graph_to_nfa(simple_graph):
     assert isinstance(nfa, NondeterministicFiniteAutomaton)
 
 
+def test_graph_to_nfa_iterables(simple_graph):
+    nfa = fa.graph_to_nfa(simple_graph, (n for n in [0]), iter([2]))
+    assert nfa.start_states == {0}
+    assert nfa.final_states == {2}
+    assert nfa.accepts("ab")
+    assert not nfa.accepts("a")
+
+    nfa = fa.graph_to_nfa(simple_graph)
+    assert nfa.start_states == nfa.final_states == {0, 1, 2}
+    assert nfa.get_number_transitions() == 2
+
+
 def test_two_cycle():
     with tempfile.NamedTemporaryFile() as tmp:
         path = tmp.name
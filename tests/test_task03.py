@@ -0,0 +1,322 @@
+import io
+import json
+
+from project.task03 import (
+    FiniteAutomaton,
+    PairSet,
+    paths_ends,
+    paths_ends_chunks,
+    prepare_graph,
+    regex_to_fa,
+)
+from project.task03.main import (
+    multi_source_reachability,
+    regex_cache,
+    transitive_closure,
+)
+from project.task02 import graph_to_nfa
+import project.task03.main as task03_main
+from project.task06 import cfpq_with_hellings
+from project.task07 import cfpq_with_matrix
+from project.task08 import cfpq_with_tensor
+from project.task09 import cfpq_with_gll
+from pyformlang.cfg import CFG
+from scipy.sparse import eye
+import numpy as np
+import pydot
+import pytest
+
+import networkx as nx
+
+
+@pytest.fixture
+def simple_graph():
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 2, label="b")
+    graph.add_edge(1, 2, label="b")
+    graph.add_edge(2, 0, label="a")
+    return graph
+
+
+def test_from_graph(simple_graph):
+    fa = FiniteAutomaton.from_graph(simple_graph, {0}, {2})
+    nfa_fa = FiniteAutomaton(graph_to_nfa(simple_graph, [0], [2]))
+
+    assert fa.matrix.keys() == nfa_fa.matrix.keys()
+    for label, matrix in fa.matrix.items():
+        assert matrix.nnz == nfa_fa.matrix[label].nnz
+    assert fa.start_indices().tolist() == [fa.state_map[0]]
+    assert fa.final_indices().tolist() == [fa.state_map[2]]
+    assert fa.start_mask.sum() == 1 and fa.final_mask[fa.state_map[2]]
+    assert fa.matrix["b"][fa.state_map[1], fa.state_map[2]]
+
+
+def test_from_csv(simple_graph, tmp_path):
+    path = tmp_path / "graph.csv"
+    path.write_text(
+        "\n".join(
+            f"{u} {v} {label}" for u, v, label in simple_graph.edges(data="label")
+        )
+    )
+
+    fa = FiniteAutomaton.from_csv(path)
+    expected = FiniteAutomaton.from_graph(simple_graph)
+
+    assert list(fa.int_map) == sorted(simple_graph.nodes)
+    assert fa.start.tolist() == fa.final.tolist() == [0, 1, 2]
+    for label, matrix in expected.matrix.items():
+        assert (fa.matrix[label] != matrix).nnz == 0
+    assert fa.state_map[2] == 2 and 3 not in fa.state_map
+
+
+def test_save_load(simple_graph, tmp_path):
+    fa = FiniteAutomaton.from_graph(simple_graph, {0}, {1, 2})
+    fa.save(tmp_path / "graph")
+    loaded = FiniteAutomaton.load(tmp_path / "graph")
+
+    assert list(loaded.int_map) == list(fa.int_map)
+    assert loaded.start.tolist() == fa.start.tolist()
+    assert loaded.final.tolist() == fa.final.tolist()
+    for label, matrix in fa.matrix.items():
+        assert (loaded.matrix[label] != matrix).nnz == 0
+        assert not loaded.matrix[label].indices.flags.writeable
+
+    # Unsorted integer ids are looked up through the stored sort order
+    graph = nx.relabel_nodes(simple_graph, {0: 9, 1: 3, 2: 5})
+    fa = FiniteAutomaton.from_graph(graph, {9}, {5})
+    fa.save(tmp_path / "unsorted")
+    loaded = FiniteAutomaton.load(tmp_path / "unsorted")
+    assert isinstance(loaded.int_map, np.memmap)
+    assert list(loaded.int_map) == [9, 3, 5]
+    assert [loaded.state_map[v] for v in (9, 3, 5)] == [0, 1, 2]
+    assert loaded.state_indices([5, 9, 7]).tolist() == [2, 0]
+    assert 7 not in loaded.state_map and "x" not in loaded.state_map
+    a, b = (loaded.matrix[label].data for label in ("a", "b"))
+    assert np.shares_memory(a, b)
+    assert paths_ends(loaded, {9}, {5}, "a b") == [(9, 5)]
+
+    for nodes in (["a", 1, "b"], [(0, "x"), (1, "y"), (2, "z")], ["a", "b", "c"]):
+        graph = nx.relabel_nodes(simple_graph, dict(zip([0, 1, 2], nodes)))
+        fa = FiniteAutomaton.from_graph(graph, {nodes[0]}, {nodes[2]})
+        fa.save(tmp_path / "relabelled")
+        loaded = FiniteAutomaton.load(tmp_path / "relabelled")
+        assert list(loaded.int_map) == nodes
+        assert [type(v) for v in loaded.int_map] == [type(v) for v in nodes]
+        assert loaded.state_indices([nodes[1]]).tolist() == [1]
+        assert paths_ends(loaded, {nodes[0]}, {nodes[2]}, "a b") == [
+            (nodes[0], nodes[2])
+        ]
+
+
+def fixpoint_closure(fa):
+    closure = sum(fa.matrix.values()) + eye(fa.size(), dtype=bool, format="csr")
+    while True:
+        nnz = closure.nnz
+        closure = closure + closure @ closure
+        if closure.nnz == nnz:
+            return closure
+
+
+@pytest.mark.parametrize("cycle", [False, True])
+def test_transitive_closure_methods(cycle):
+    graph = nx.MultiDiGraph()
+    for i in range(40):
+        graph.add_edge(i, i + 1, label="ab"[i % 2])
+    if cycle:
+        graph.add_edge(40, 20, label="a")
+    fa = FiniteAutomaton.from_graph(graph)
+
+    expected = fixpoint_closure(fa)
+    assert expected.nnz == (41 * 42 // 2 + (20 * 21 // 2 if cycle else 0))
+    for method in ("squaring", "bfs", None):
+        assert (transitive_closure(fa, method) != expected).nnz == 0
+    with pytest.raises(ValueError):
+        transitive_closure(fa, "naive")
+
+
+def test_multi_source_reachability(simple_graph):
+    fa = FiniteAutomaton.from_graph(simple_graph)
+    closure = transitive_closure(fa)
+    reachable = multi_source_reachability(fa, [2, 0])
+
+    assert (reachable[0] != closure[2]).nnz == 0
+    assert (reachable[1] != closure[0]).nnz == 0
+
+
+def test_to_nfa(simple_graph):
+    nfa = graph_to_nfa(simple_graph, [0], [2])
+    exported = FiniteAutomaton(nfa).to_nfa()
+
+    assert exported.start_states == nfa.start_states
+    assert exported.final_states == nfa.final_states
+    assert exported.is_equivalent_to(nfa)
+
+
+def test_write_csv(simple_graph, tmp_path):
+    fa = FiniteAutomaton.from_graph(simple_graph)
+    fa.write_csv(tmp_path / "graph.csv")
+    loaded = FiniteAutomaton.from_csv(tmp_path / "graph.csv")
+
+    for label, matrix in fa.matrix.items():
+        assert (loaded.matrix[label] != matrix).nnz == 0
+
+    stream = io.StringIO()
+    fa.write_csv(stream)
+    assert stream.getvalue() == (tmp_path / "graph.csv").read_text()
+
+    with pytest.raises(ValueError):
+        prepare_graph(nx.relabel_nodes(simple_graph, {0: "x"})).write_csv(stream)
+    simple_graph.add_edge(0, 2, label="a b")
+    with pytest.raises(ValueError):
+        prepare_graph(simple_graph).write_csv(stream)
+
+
+def test_write_dot(simple_graph, tmp_path):
+    graph = nx.relabel_nodes(simple_graph, {2: "two words"})
+    graph.add_edge(0, "two words", label="c d")
+    fa = FiniteAutomaton.from_graph(graph, {0}, {"two words"})
+    fa.write_dot(tmp_path / "graph.dot")
+    stream = io.StringIO()
+    fa.write_dot(stream)
+    assert stream.getvalue() == (tmp_path / "graph.dot").read_text()
+
+    dot = pydot.graph_from_dot_data(stream.getvalue())[0]
+    edges = set(
+        tuple(json.loads(value) for value in (e.get_source(), e.get_destination()))
+        + (json.loads(e.get_attributes()["label"]),)
+        for e in dot.get_edges()
+    )
+    assert edges == {
+        (str(u), str(v), label) for u, v, label in graph.edges(data="label")
+    }
+    marked = {
+        json.loads(node.get_name()): node.get_attributes() for node in dot.get_nodes()
+    }
+    assert marked == {"0": {"is_start": "True"}, "two words": {"is_final": "True"}}
+
+
+def test_regex_cache():
+    regex_cache.clear()
+    first = regex_to_fa("a* b")
+    second = regex_to_fa(" a*  b ")
+
+    assert first is second
+    assert regex_cache.info()["hits"] == 1 and regex_cache.info()["misses"] == 1
+    assert first.accepts("aab") and not first.accepts("ba")
+
+    with pytest.raises(TypeError):
+        first.matrix["c"] = first.matrix["a"]
+    with pytest.raises(ValueError):
+        first.start[0] = 1
+    with pytest.raises(ValueError):
+        first.matrix["a"].indices[0] = 0
+    with pytest.raises(TypeError):
+        first.state_map[first.int_map[0]] = 1
+
+
+def test_prepare_graph(simple_graph):
+    prepared = prepare_graph(simple_graph)
+    for start_nodes, final_nodes in [({0}, {2}), ({1}, {0, 2}), ({0, 1, 2}, {0})]:
+        assert set(paths_ends(prepared, start_nodes, final_nodes, "a b*")) == set(
+            paths_ends(simple_graph, start_nodes, final_nodes, "a b*")
+        )
+
+
+def test_paths_ends_chunks(simple_graph):
+    graph = nx.relabel_nodes(simple_graph, {0: (0, "x"), 1: (1, "y"), 2: (2, "z")})
+    expected = set(paths_ends(graph, set(), set(), "(a b* | b)*"))
+    assert len(expected) == 9
+
+    chunks = list(paths_ends_chunks(graph, set(), set(), "(a b* | b)*", chunk_size=1))
+    assert len(chunks) == 3
+    pairs = [pair for sources, targets in chunks for pair in zip(sources, targets)]
+    assert len(pairs) == len(expected)
+    assert set(pairs) == expected
+
+    prepared = prepare_graph(simple_graph)
+    for sources, targets in paths_ends_chunks(prepared, {0}, {1, 2}, "a b*"):
+        assert sources.tolist() == [0, 0]
+        assert targets.tolist() == [1, 2]
+
+
+@pytest.mark.parametrize("threshold", [1.0, 0.0])
+def test_paths_ends_chunks_work(monkeypatch, threshold):
+    graph = nx.MultiDiGraph()
+    for i in range(10):
+        graph.add_edge(i, i + 1, label="a")
+
+    calls = []
+    closures = []
+
+    def reachability(fa, sources, adjacency=None):
+        calls.append(len(sources))
+        return multi_source_reachability(fa, sources, adjacency)
+
+    def closure(fa):
+        closures.append(fa.size())
+        return transitive_closure(fa)
+
+    monkeypatch.setattr(task03_main, "MULTI_SOURCE_THRESHOLD", threshold)
+    monkeypatch.setattr(task03_main, "multi_source_reachability", reachability)
+    monkeypatch.setattr(task03_main, "transitive_closure", closure)
+    chunks = paths_ends_chunks(graph, set(), set(), "a*", chunk_size=4)
+    sources, targets = next(chunks)
+    if threshold:
+        # Few sources: one search per chunk, run only when the chunk is needed
+        assert calls == [4] and closures == []
+    else:
+        # Many sources: one closure up front, chunks are its row slices
+        assert calls == [] and closures == [11]
+    assert sorted(set(sources.tolist())) == [0, 1, 2, 3]
+    assert len(sources) == 11 + 10 + 9 + 8
+
+    rest = list(chunks)
+    assert len(rest) == 2
+    assert calls == ([4, 4, 3] if threshold else [])
+    assert len(closures) == (0 if threshold else 1)
+    assert len(paths_ends(graph, set(), set(), "a*")) == 66
+
+
+def test_pair_set(simple_graph):
+    fa = prepare_graph(simple_graph)
+    pairs = PairSet.from_pairs([(0, 1), (1, 2), (2, 0)], fa)
+    assert len(pairs) == 3
+    assert (1, 2) in pairs
+    assert (2, 1) not in pairs
+    assert (5, 0) not in pairs
+    assert pairs == {(0, 1), (1, 2), (2, 0)}
+
+    other = PairSet.from_pairs([(1, 2), (0, 0)], fa)
+    assert isinstance(pairs | other, PairSet)
+    assert (pairs | other).to_set() == {(0, 1), (1, 2), (2, 0), (0, 0)}
+    assert (pairs & other).to_set() == {(1, 2)}
+    assert pairs & {(0, 1), (7, 7)} == {(0, 1)}
+
+    sources, targets = pairs.arrays()
+    assert sorted(zip(sources, targets)) == [(0, 1), (1, 2), (2, 0)]
+
+
+@pytest.mark.parametrize(
+    "algorithm", [cfpq_with_hellings, cfpq_with_matrix, cfpq_with_tensor, cfpq_with_gll]
+)
+def test_compact_results(simple_graph, algorithm):
+    cfg = CFG.from_text("S -> a S b | a b")
+    expected = algorithm(cfg, simple_graph, {0, 1}, {1, 2})
+    result = algorithm(cfg, simple_graph, {0, 1}, {1, 2}, compact=True)
+    assert isinstance(result, PairSet)
+    assert result == expected
+    assert result.to_set() == expected
+
+
+def test_unknown_nodes_are_skipped(simple_graph, tmp_path):
+    path = tmp_path / "graph.csv"
+    path.write_text("0 1 a\n1 2 b\n")
+    for graph in (simple_graph, prepare_graph(simple_graph), prepare_graph(path)):
+        assert paths_ends(graph, {0, 99}, {2}, "a b") == [(0, 2)]
+        assert paths_ends(graph, {99}, {2}, "a b") == []
+        assert paths_ends(graph, {"x"}, {2}, "a b") == []
+
+    fa = prepare_graph(simple_graph).with_states({0, 99}, {"x"})
+    assert fa.start.tolist() == [0]
+    assert fa.final.tolist() == []
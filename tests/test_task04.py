@@ -0,0 +1,42 @@
+from project.task02 import regex_to_dfa
+from project.task03 import FiniteAutomaton, paths_ends
+from project.task04 import reachability_with_constraints
+
+import networkx as nx
+
+
+def test_iterations_follow_diameter():
+    graph = nx.MultiDiGraph()
+    for i in range(10):
+        graph.add_edge(i, i + 1, label="a")
+    fa = FiniteAutomaton.from_graph(graph, {0, 5}, {10})
+    constraints_fa = FiniteAutomaton(regex_to_dfa("a*"))
+
+    res, iterations = reachability_with_constraints(
+        fa, constraints_fa, return_iterations=True
+    )
+
+    assert res[0] == {10} and res[5] == {10}
+    assert iterations == 11
+
+
+def test_batch_sizes_agree():
+    graph = nx.MultiDiGraph()
+    edges = [(0, 1, "a"), (1, 2, "b"), (0, 3, "b"), (3, 3, "a"), (3, 2, "c")]
+    edges += [(2, 4, "a"), (4, 0, "b"), (5, 3, "b"), (4, 5, "c"), (5, 1, "a")]
+    for u, v, label in edges:
+        graph.add_edge(u, v, label=label)
+    starts = {0, 2, 3, 4, 5}
+    fa = FiniteAutomaton.from_graph(graph, starts, {1, 2, 3})
+    regex = "(a b | b a* c)*"
+    constraints_fa = FiniteAutomaton(regex_to_dfa(regex))
+
+    results = [
+        reachability_with_constraints(fa, constraints_fa, batch_size)
+        for batch_size in (1, 2, None)
+    ]
+    expected = {s: set() for s in graph.nodes}
+    for u, v in paths_ends(graph, starts, {1, 2, 3}, regex):
+        expected[u].add(v)
+    assert results[0] == results[1] == results[2] == expected
+    assert expected[0] == {2} and expected[5] == {2}
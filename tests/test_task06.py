@@ -0,0 +1,31 @@
+from project.task06 import compile_grammar, cfpq_with_hellings
+from project.task06.main import grammar_cache
+from pyformlang.cfg import CFG
+import networkx as nx
+import pytest
+
+
+def test_compiled_grammar_cache():
+    grammar = compile_grammar(CFG.from_text("S -> a S b | a b"))
+    hits = grammar_cache.hits
+    assert compile_grammar(CFG.from_text("S -> a b | a S b")) is grammar
+    assert grammar_cache.hits == hits + 1
+    assert compile_grammar(grammar) is grammar
+    with pytest.raises(TypeError):
+        grammar.P_terminal["c"] = (0,)
+    with pytest.raises(AttributeError):
+        grammar.P_epsilon.append(0)
+    assert compile_grammar(CFG.from_text("S -> a S b | b a")) is not grammar
+
+
+def test_algorithms_with_compiled_grammar():
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 1, label="a")
+    graph.add_edge(1, 2, label="b")
+    cfg = CFG.from_text("S -> A B\nA -> a A | a\nB -> b")
+    grammar = compile_grammar(cfg)
+    expected = {(0, 2), (1, 2)}
+    assert cfpq_with_hellings(cfg, graph) == expected
+    assert cfpq_with_hellings(grammar, graph) == expected
+    assert cfpq_with_hellings(grammar, graph, {0}) == {(0, 2)}
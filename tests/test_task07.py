@@ -0,0 +1,46 @@
+from project.task06 import compile_grammar
+from project.task07 import GrammarPlan, cfpq_with_matrix
+from project.task07.main import grammar_plan
+from pyformlang.cfg import CFG, Variable
+import networkx as nx
+import pytest
+
+
+def test_grammar_plan_order():
+    plan = GrammarPlan(CFG.from_text("S -> A B\nA -> a A | a\nB -> b"))
+    S, A = plan.ids[Variable("S")], plan.ids[Variable("A")]
+    components = [
+        ({N for heads in bodies.values() for N in heads}, recursive)
+        for bodies, recursive in plan.components
+    ]
+    assert components == [({A}, True), ({S}, False)]
+
+
+def test_matrix_with_plan():
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 1, label="a")
+    graph.add_edge(1, 2, label="b")
+    cfg = CFG.from_text("S -> A B\nA -> a A | a\nB -> b")
+    plan = GrammarPlan(cfg)
+    expected = {(0, 2), (1, 2)}
+    assert cfpq_with_matrix(cfg, graph) == expected
+    assert cfpq_with_matrix(plan, graph) == expected
+    assert cfpq_with_matrix(plan, graph, {0}) == {(0, 2)}
+
+
+def test_plan_from_compiled_grammar():
+    cfg = CFG.from_text("S -> A B\nA -> a A | a\nB -> b")
+    grammar = compile_grammar(cfg)
+    plan = grammar_plan(cfg)
+    assert plan.ids is grammar.ids
+    assert grammar_plan(grammar) is plan
+    assert grammar_plan(plan) is plan
+    bodies, _ = plan.components[0]
+    with pytest.raises(TypeError):
+        bodies[(0, 0)] = (0,)
+
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 2, label="b")
+    assert cfpq_with_matrix(grammar, graph) == {(0, 2)}
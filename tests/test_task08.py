@@ -0,0 +1,67 @@
+from project.task08 import CompiledRsm, cfg_to_rsm, cfpq_with_tensor, rsm_to_mat
+from project.task08.main import rsm_cache
+from pyformlang.cfg import CFG
+import networkx as nx
+import numpy as np
+import pytest
+
+
+def test_compiled_rsm_layout():
+    rsm = rsm_to_mat(CFG.from_text("S -> a S b | $\nA -> a"))
+    assert rsm.boxes == ("A", "S")
+    assert rsm.offsets.tolist() == [0, 2, 6]
+    assert rsm.box.tolist() == [0, 0, 1, 1, 1, 1]
+    assert rsm.initial == "S"
+    assert rsm.start_mask.sum() == 2
+    assert np.all(rsm.start_mask[rsm.offsets[:-1]])
+    assert set(rsm.matrix) == {"a", "b", "S"}
+    assert rsm.matrix["a"].nnz == 2
+
+
+def test_compiled_rsm_cache():
+    cfg = CFG.from_text("S -> a S b | a b")
+    rsm = rsm_to_mat(cfg)
+    hits = rsm_cache.hits
+    assert rsm_to_mat(CFG.from_text("S -> a b | a S b")) is rsm
+    assert rsm_to_mat(cfg_to_rsm(cfg)) is rsm_to_mat(cfg_to_rsm(cfg))
+    assert rsm_cache.hits == hits + 2
+    assert rsm_to_mat(rsm) is rsm
+    with pytest.raises(ValueError):
+        rsm.start_mask[0] = False
+    with pytest.raises(ValueError):
+        rsm.matrix["a"].indices[0] = 0
+    with pytest.raises(TypeError):
+        rsm.matrix["c"] = rsm.matrix["a"]
+
+
+def test_compiled_rsm_save_load(tmp_path):
+    cfg = CFG.from_text("S -> a S b | a b")
+    rsm = CompiledRsm.from_rsm(cfg_to_rsm(cfg))
+    rsm.save(tmp_path / "rsm")
+    loaded = CompiledRsm.load(tmp_path / "rsm")
+    assert loaded.boxes == rsm.boxes
+    assert loaded.initial == rsm.initial
+    assert loaded.offsets.tolist() == rsm.offsets.tolist()
+    assert loaded.start_mask.tolist() == rsm.start_mask.tolist()
+    assert loaded.final_mask.tolist() == rsm.final_mask.tolist()
+    for label, matrix in rsm.matrix.items():
+        assert (loaded.matrix[label] != matrix).nnz == 0
+
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 2, label="a")
+    graph.add_edge(2, 3, label="b")
+    graph.add_edge(3, 4, label="b")
+    expected = {(0, 4), (1, 3)}
+    assert cfpq_with_tensor(cfg, graph) == expected
+    assert cfpq_with_tensor(loaded, graph) == expected
+
+
+def test_tensor_unknown_nodes():
+    graph = nx.MultiDiGraph()
+    graph.add_edge(3, 5, label="a")
+    graph.add_edge(5, 7, label="b")
+    cfg = CFG.from_text("S -> a b")
+    assert cfpq_with_tensor(cfg, graph, {3, 99}, {7}) == {(3, 7)}
+    assert cfpq_with_tensor(cfg, graph, {99}, {7}) == set()
+    assert cfpq_with_tensor(cfg, graph, {3}, {7, "x"}) == {(3, 7)}